@@ -1,19 +1,48 @@
 import os
 import sys
 import gzip
-from io import BytesIO
+import zlib
+# Errors raised by a corrupted gzip stream
+DECOMPRESS_ERRORS = (zlib.error, OSError, EOFError)
+try: # ISA-L's SIMD inflate is a drop-in replacement for the gzip and zlib modules
+	from isal import igzip as gzip, isal_zlib as zlib
+	DECOMPRESS_ERRORS = DECOMPRESS_ERRORS + (zlib.error,) # IsalError, which does not derive from zlib.error
+except ImportError:
+	pass
+from io import BytesIO, RawIOBase
 import json
+try: # orjson is several times faster than json, and produces bytes directly
+	import orjson
+	json_loads = orjson.loads
+	json_dumps = orjson.dumps
+except ImportError:
+	json_loads = json.loads
+	def json_dumps(obj):
+		return json.dumps(obj).encode('utf-8')
 import hashlib
+import time
 import shutil
 import requests
 import tarfile
 import urllib3
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 urllib3.disable_warnings()
 
+# Single session for every request, so connections and TLS sessions are reused
+# The pool is sized for the download workers: 5 layers with up to 8 range requests each, plus the image config
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=48, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])))
+
 parser = argparse.ArgumentParser(description='Pull Docker images without a Docker daemon by directly interacting with the registry API.')
 parser.add_argument('image', help='The Docker image to pull, e.g., "ubuntu:latest" or "hello-world@<digest>"')
 parser.add_argument('--platform', help='Set platform to pull a specific architecture, e.g., "linux/amd64" or "arm64"')
+parser.add_argument('--mirror', default=os.environ.get('DEPENDENCY_PROXY'), help='Registry mirror tried first for Docker Hub layers, e.g. mirror.gcr.io (default: $DEPENDENCY_PROXY)')
+parser.add_argument('--format', choices=['docker', 'oci'], default='docker', help='Archive layout: "docker" (docker save format, decompressed layers) or "oci" (OCI image layout, layers kept compressed)')
+parser.add_argument('--cache-dir', help='Keep manifests and layers in this folder and reuse them on the next pulls')
 args = parser.parse_args()
 
 
@@ -43,7 +72,7 @@ repository = '{}/{}'.format(repo, img)
 # Get Docker authentication endpoint when it is required
 auth_url='https://auth.docker.io/token'
 reg_service='registry.docker.io'
-resp = requests.get('https://{}/v2/'.format(registry), verify=False)
+resp = session.get('https://{}/v2/'.format(registry), verify=False)
 if resp.status_code == 401:
 	auth_url = resp.headers['WWW-Authenticate'].split('"')[1]
 	try:
@@ -51,37 +80,124 @@ if resp.status_code == 401:
 	except IndexError:
 		reg_service = ""
 
-# Get Docker token (this function is useless for unauthenticated registries like Microsoft)
-def get_auth_head(type):
-	resp = requests.get('{}?service={}&scope=repository:{}:pull'.format(auth_url, reg_service, repository), verify=False)
-	access_token = resp.json()['token']
-	auth_head = {'Authorization':'Bearer '+ access_token, 'Accept': type}
-	return auth_head
-
-# Docker style progress bar
-def progress_bar(ublob, nb_traits):
-	sys.stdout.write('\r' + ublob[7:19] + ': Downloading [')
-	for i in range(0, nb_traits):
-		if i == nb_traits - 1:
-			sys.stdout.write('>')
-		else:
-			sys.stdout.write('=')
-	for i in range(0, 49 - nb_traits):
-		sys.stdout.write(' ')
-	sys.stdout.write(']')
-	sys.stdout.flush()
+# Docker Hub blobs are fetched from the mirror when possible, it doesn't count against the Docker Hub rate limits
+mirror = args.mirror if registry == 'registry-1.docker.io' else None
+if mirror: # an unreachable mirror is given up at once instead of retrying the connection
+	session.mount('https://{}/'.format(mirror.partition('/')[0]), HTTPAdapter(pool_connections=16, pool_maxsize=48, max_retries=Retry(total=3, connect=0, backoff_factor=0.3, status_forcelist=[502, 503, 504])))
+
+# Get Docker token (this is useless for unauthenticated registries like Microsoft)
+# The token is kept and only requested again when it is about to expire
+class TokenCache:
+	def __init__(self):
+		self.token = None
+		self.expires_at = 0
+		self.lock = threading.Lock()
+
+	def get_auth_head(self, type):
+		with self.lock:
+			if self.token is None or time.monotonic() >= self.expires_at:
+				resp = session.get('{}?service={}&scope=repository:{}:pull'.format(auth_url, reg_service, repository), verify=False)
+				self.token = resp.json()['token']
+				# Tokens last 60 seconds unless stated otherwise, renew 30 seconds ahead
+				self.expires_at = time.monotonic() + resp.json().get('expires_in', 60) - 30
+			auth_head = {'Authorization':'Bearer '+ self.token, 'Accept': type}
+		return auth_head
+
+get_auth_head = TokenCache().get_auth_head
+
+# Renew the token of registry headers (mirror headers carry none) as a slow download may outlive it
+def renew_auth_head(auth_head):
+	return get_auth_head(auth_head['Accept']) if 'Authorization' in auth_head else auth_head
+
+# Set when the pull fails, so the download workers still running give up
+aborted = threading.Event()
+
+# Serializes terminal output from the download workers
+stdout_lock = threading.Lock()
+
+# Bytes downloaded so far for each layer digest, drawn together as a single Docker style progress bar
+progress = {}
+progress_total = 0
+progress_traits = 0
+
+# Count downloaded bytes for a layer (reset=True when its download starts over), redrawing the bar when it moves
+def progress_bar(ublob, nbytes, reset=False):
+	global progress_traits
+	with stdout_lock:
+		progress[ublob] = nbytes if reset else progress.get(ublob, 0) + nbytes
+		nb_traits = min(sum(progress.values()) * 50 // max(progress_total, 1), 50)
+		if nb_traits != progress_traits:
+			progress_traits = nb_traits
+			sys.stdout.write('\rDownloading [' + '='*(nb_traits-1) + '>' + ' '*(49-nb_traits) + ']')
+			sys.stdout.flush()
+
+# Print lines over the progress bar, which is drawn again on the next update
+def print_status(*lines):
+	global progress_traits
+	with stdout_lock:
+		for line in lines:
+			print('\r{}{}'.format(line, ' '*(64 - len(str(line)))))
+		progress_traits = -1
+
+# Store data in the cache through a temporary file, so that a partial write is never picked up
+def cache_write(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path + '.part', 'wb') as file:
+		file.write(data)
+	os.replace(path + '.part', path)
+
+# Location of a blob in the cache folder (blobs are content addressed, so a cached one is always valid)
+def cached_blob(digest, suffix=''):
+	return os.path.join(args.cache_dir, 'blobs', digest.replace(':', os.sep) + suffix)
+
+# Get a manifest, reusing the cached copy when a HEAD request shows its digest didn't change
+def fetch_manifest(reference, auth_head):
+	url = 'https://{}/v2/{}/manifests/{}'.format(registry, repository, reference)
+	if args.cache_dir:
+		cache_file = os.path.join(args.cache_dir, repository, reference.replace(':', '@'))
+		if os.path.exists(cache_file + '.digest'):
+			hresp = session.head(url, headers=auth_head, verify=False)
+			with open(cache_file + '.digest') as file:
+				cached_digest = file.read()
+			if hresp.status_code == 200 and hresp.headers.get('Docker-Content-Digest') == cached_digest:
+				with open(cache_file + '.json', 'rb') as file:
+					return 200, file.read()
+	resp = session.get(url, headers=auth_head, verify=False)
+	if resp.status_code == 200 and args.cache_dir:
+		digest = resp.headers.get('Docker-Content-Digest', 'sha256:' + hashlib.sha256(resp.content).hexdigest())
+		cache_write(cache_file + '.json', resp.content)
+		cache_write(cache_file + '.digest', digest.encode('utf-8'))
+	return resp.status_code, resp.content
+
+# Request a blob from the mirror first if there is one, falling back to the registry itself
+# Returns the response along with the url and headers that served it
+def get_blob(ublob, auth_head, stream=False):
+	global mirror
+	if mirror:
+		mirror_host, _, mirror_prefix = mirror.partition('/')
+		url = 'https://{}/v2/{}/blobs/{}'.format(mirror_host, '/'.join(filter(None, [mirror_prefix, repository])), ublob)
+		headers = {'Accept': auth_head['Accept']} # public images are readable anonymously, keep the registry token to the registry
+		try:
+			resp = session.get(url, headers=headers, stream=stream, verify=False, timeout=(5, None))
+			if resp.status_code == 200:
+				return resp, url, headers
+			resp.close()
+		except requests.exceptions.RequestException: # unreachable mirror, stop trying it
+			mirror = None
+	url = 'https://{}/v2/{}/blobs/{}'.format(registry, repository, ublob)
+	return session.get(url, headers=auth_head, stream=stream, verify=False), url, auth_head
 
 # Fetch manifest v2 and get image layer digests
 # First, try to get a manifest list or a single manifest
 auth_head = get_auth_head('application/vnd.docker.distribution.manifest.list.v2+json, application/vnd.docker.distribution.manifest.v2+json')
-resp = requests.get('https://{}/v2/{}/manifests/{}'.format(registry, repository, tag), headers=auth_head, verify=False)
+status, manifest_raw = fetch_manifest(tag, auth_head)
 
-if resp.status_code != 200:
-    print('[-] Cannot fetch manifest for {} [HTTP {}]'.format(repository, resp.status_code))
-    print(resp.content)
+if status != 200:
+    print('[-] Cannot fetch manifest for {} [HTTP {}]'.format(repository, status))
+    print(manifest_raw)
     exit(1)
 
-manifest_data = resp.json()
+manifest_data = json_loads(manifest_raw)
 
 # Handle manifest list (multi-architecture)
 if 'manifests' in manifest_data:
@@ -153,12 +269,12 @@ if 'manifests' in manifest_data:
             
             # Re-fetch the specific manifest using its digest
             auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json')
-            resp = requests.get('https://{}/v2/{}/manifests/{}'.format(registry, repository, digest), headers=auth_head, verify=False)
-            if resp.status_code != 200:
-                print(f'[-] Failed to fetch manifest for digest {digest} [HTTP {resp.status_code}]')
-                print(resp.content)
+            status, manifest_raw = fetch_manifest(digest, auth_head)
+            if status != 200:
+                print(f'[-] Failed to fetch manifest for digest {digest} [HTTP {status}]')
+                print(manifest_raw)
                 exit(1)
-            manifest_data = resp.json()
+            manifest_data = json_loads(manifest_raw)
 
     # If --platform is NOT specified for a multi-arch image, print list and exit
     else:
@@ -181,24 +297,48 @@ if 'manifests' in manifest_data:
 # At this point, manifest_data should be a single-architecture manifest
 if 'layers' not in manifest_data:
     print(f'[-] Unexpected manifest format for {repository}. Expected a single manifest but got something else.')
-    print(resp.text)
+    print(manifest_raw.decode('utf-8'))
     exit(1)
 
 layers = manifest_data['layers']
+progress_total = sum(layer.get('size', 0) for layer in layers)
 
-# Create tmp folder that will hold the image
+# Create tmp folder that will hold the downloaded layers until they are archived
 imgdir = 'tmp_{}_{}'.format(img, tag.replace(':', '@'))
 os.mkdir(imgdir)
 print('Creating image structure in: ' + imgdir)
 
-config = resp.json()['config']['digest']
-confresp = requests.get('https://{}/v2/{}/blobs/{}'.format(registry, repository, config), headers=auth_head, verify=False)
-file = open('{}/{}.json'.format(imgdir, config[7:]), 'wb')
-file.write(confresp.content)
-file.close()
+# The image archive is written as we go, so the full image never sits on disk twice
+# It is renamed once complete, a failed pull must not leave a truncated image behind
+docker_tar = repo.replace('/', '_') + '_' + img + '.tar'
+tar = tarfile.open(docker_tar + '.part', "w|", bufsize=1024*1024)
+
+# Add an in-memory file to the image archive
+def tar_add_bytes(name, data):
+	info = tarfile.TarInfo(name)
+	info.size = len(data)
+	info.mtime = time.time()
+	tar.addfile(info, BytesIO(data))
+
+# Get the image config blob, from the cache when possible
+def fetch_config(config):
+	if args.cache_dir and os.path.exists(cached_blob(config)):
+		with open(cached_blob(config), 'rb') as file:
+			return file.read()
+	confresp, _, _ = get_blob(config, auth_head)
+	if args.cache_dir and hashlib.sha256(confresp.content).hexdigest() == config[7:]:
+		cache_write(cached_blob(config), confresp.content)
+	return confresp.content
+
+config = manifest_data['config']['digest']
+# The OCI layout keeps every blob under its digest
+if args.format == 'oci':
+	config_name = 'blobs/' + config.replace(':', '/')
+else:
+	config_name = config[7:] + '.json'
 
 content = [{
-	'Config': config[7:] + '.json',
+	'Config': config_name,
 	'RepoTags': [ ],
 	'Layers': [ ]
 	}]
@@ -210,95 +350,298 @@ else:
 empty_json = '{"created":"1970-01-01T00:00:00Z","container_config":{"Hostname":"","Domainname":"","User":"","AttachStdin":false, \
 	"AttachStdout":false,"AttachStderr":false,"Tty":false,"OpenStdin":false, "StdinOnce":false,"Env":null,"Cmd":null,"Image":"", \
 	"Volumes":null,"WorkingDir":"","Entrypoint":null,"OnBuild":null,"Labels":null}}'
+# Parsed once, each layer gets a shallow copy (only top-level id and parent are set)
+empty_json_template = json_loads(empty_json)
 
-# Build layer folders
-parentid=''
-for layer in layers:
+# Read-only raw stream feeding every byte read into a hash
+# Both readinto (used by isal's GzipFile) and read (derived from it) go through the hash
+class HashingReader(RawIOBase):
+	def __init__(self, file, hash):
+		self.file = file
+		self.hash = hash
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		size = self.file.readinto(buffer)
+		self.hash.update(memoryview(buffer)[:size])
+		return size
+
+# Size of the reads from the network and of the layer file buffers
+CHUNK = 1 << 20
+
+# Blobs larger than this are fetched as parallel HTTP range requests
+RANGE_THRESHOLD = 50 * 1024 * 1024
+RANGE_CHUNK = 32 * 1024 * 1024
+
+# Reserve the whole file up front, so it gets one extent instead of growing chunk by chunk
+def preallocate(fd, size):
+	try:
+		os.posix_fallocate(fd, 0, size)
+	except (AttributeError, OSError): # Not available on macOS and Windows, or not supported by the filesystem
+		os.ftruncate(fd, size)
+
+# Fetch a blob as parallel range requests written in place with pwrite, returns False if the server ignores Range
+def download_ranges(url, auth_head, path, ublob, size):
+	def download_range(start):
+		end = min(start + RANGE_CHUNK, size) - 1
+		rresp = session.get(url, headers=dict(renew_auth_head(auth_head), Range='bytes={}-{}'.format(start, end)), stream=True, verify=False)
+		if rresp.status_code != 206:
+			rresp.close()
+			return False
+		offset = start
+		for chunk in rresp.iter_content(chunk_size=CHUNK):
+			if aborted.is_set():
+				exit(1)
+			if chunk:
+				os.pwrite(fd, chunk, offset)
+				offset = offset + len(chunk)
+				progress_bar(ublob, len(chunk))
+		return offset == end + 1
+
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+	complete = False
+	try:
+		preallocate(fd, size)
+		with ThreadPoolExecutor(max_workers=8) as executor:
+			complete = all(list(executor.map(download_range, range(0, size, RANGE_CHUNK))))
+	finally:
+		os.close(fd)
+		if not complete: # the blob is downloaded again as a single stream, possibly to another path
+			os.remove(path)
+	return complete
+
+# Download a layer blob to path (or into the cache), run concurrently by the worker pool
+# The blob is decompressed for the docker format and kept as is for the OCI one
+# Returns the path of the resulting file
+def download_blob(layer, path):
 	ublob = layer['digest']
-	# FIXME: Creating fake layer ID. Don't know how Docker generates it
-	fake_layerid = hashlib.sha256((parentid+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
-	layerdir = imgdir + '/' + fake_layerid
-	os.mkdir(layerdir)
-
-	# Creating VERSION file
-	file = open(layerdir + '/VERSION', 'w')
-	file.write('1.0')
-	file.close()
-
-	# Creating layer.tar file
-	sys.stdout.write(ublob[7:19] + ': Downloading...')
-	sys.stdout.flush()
-	auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json') # refreshing token to avoid its expiration
-	bresp = requests.get('https://{}/v2/{}/blobs/{}'.format(registry, repository, ublob), headers=auth_head, stream=True, verify=False)
+	if args.cache_dir:
+		cache_file = cached_blob(ublob, '.tar' if args.format == 'docker' else '')
+		if os.path.exists(cache_file):
+			print_status('{}: Already exists'.format(ublob[7:19]))
+			progress_bar(ublob, layer.get('size', 0))
+			return cache_file
+	auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json') # refreshed only when close to expiration
+	bresp, url, blob_head = get_blob(ublob, auth_head, stream=True)
 	if (bresp.status_code != 200): # When the layer is located at a custom URL
-		bresp = requests.get(layer['urls'][0], headers=auth_head, stream=True, verify=False)
+		url = layer['urls'][0]
+		blob_head = auth_head
+		bresp = session.get(url, headers=blob_head, stream=True, verify=False)
 		if (bresp.status_code != 200):
-			print('\rERROR: Cannot download layer {} [HTTP {}]'.format(ublob[7:19], bresp.status_code, bresp.headers['Content-Length']))
-			print(bresp.content)
+			print_status('ERROR: Cannot download layer {} [HTTP {}]'.format(ublob[7:19], bresp.status_code), bresp.content)
 			exit(1)
-	# Stream download and follow the progress
 	bresp.raise_for_status()
-	unit = int(bresp.headers['Content-Length']) / 50
-	acc = 0
-	nb_traits = 0
-	progress_bar(ublob, nb_traits)
-	with open(layerdir + '/layer_gzip.tar', "wb") as file:
-		for chunk in bresp.iter_content(chunk_size=8192): 
-			if chunk:
-				file.write(chunk)
-				acc = acc + 8192
-				if acc > unit:
-					nb_traits = nb_traits + 1
-					progress_bar(ublob, nb_traits)
-					acc = 0
-	sys.stdout.write("\r{}: Extracting...{}".format(ublob[7:19], " "*50)) # Ugly but works everywhere
-	sys.stdout.flush()
-	with open(layerdir + '/layer.tar', "wb") as file: # Decompress gzip response
-		unzLayer = gzip.open(layerdir + '/layer_gzip.tar','rb')
-		shutil.copyfileobj(unzLayer, file)
-		unzLayer.close()
-	os.remove(layerdir + '/layer_gzip.tar')
-	print("\r{}: Pull complete [{}]".format(ublob[7:19], bresp.headers['Content-Length']))
-	content[0]['Layers'].append(fake_layerid + '/layer.tar')
-	
-	# Creating json file
-	file = open(layerdir + '/json', 'w')
-	# last layer = config manifest - history - rootfs
-	if layers[-1]['digest'] == layer['digest']:
-		# FIXME: json.loads() automatically converts to unicode, thus decoding values whereas Docker doesn't
-		json_obj = json.loads(confresp.content)
-		del json_obj['history']
+	size = int(bresp.headers['Content-Length'])
+	# Uncompressed layers (media type ending in .tar instead of .tar.gzip) and OCI archives use the blob as is
+	decompress = args.format == 'docker' and not layer.get('mediaType', '').endswith('.tar')
+	# Large blobs are split across several connections when the server supports it
+	ranged = size > RANGE_THRESHOLD and bresp.headers.get('Accept-Ranges') == 'bytes' and hasattr(os, 'pwrite')
+	if ranged:
+		bresp.close()
+		ranged = download_ranges(url, blob_head, path + '.gz' if decompress else path, ublob, size)
+		if not ranged: # Range not honoured, start over with a single stream
+			progress_bar(ublob, 0, reset=True)
+			bresp = session.get(url, headers=renew_auth_head(blob_head), stream=True, verify=False)
+			bresp.raise_for_status()
+	# The digest is computed on the fly as the compressed bytes go through
+	algo, expected = ublob.split(':')
+	blob_hash = hashlib.new(algo)
+	# A corrupted blob fails to decompress before the end, the digest is still completed to report it
+	unzip_error = None
+	if ranged and decompress:
+		# Pieces arrived out of order, so the gzip stream can only be decoded (and hashed) once the file is complete
 		try:
-			del json_obj['rootfs']
-		except: # Because Microsoft loves case insensitiveness
-			del json_obj['rootfS']
-	else: # other layers json are empty
-		json_obj = json.loads(empty_json)
-	json_obj['id'] = fake_layerid
-	if parentid:
-		json_obj['parent'] = parentid
-	parentid = json_obj['id']
-	file.write(json.dumps(json_obj))
-	file.close()
-
-file = open(imgdir + '/manifest.json', 'w')
-file.write(json.dumps(content))
-file.close()
+			with open(path, "wb", buffering=CHUNK) as file, open(path + '.gz', 'rb') as gzfile:
+				try:
+					unzLayer = gzip.GzipFile(fileobj=HashingReader(gzfile, blob_hash), mode='rb')
+					shutil.copyfileobj(unzLayer, file, length=CHUNK)
+					unzLayer.close()
+				except DECOMPRESS_ERRORS as e:
+					unzip_error = e
+				for data in iter(lambda: gzfile.read(CHUNK), b''): # left unread by a failed decompression
+					blob_hash.update(data)
+		finally:
+			os.remove(path + '.gz')
+	elif ranged:
+		# Pieces were written in place, only the digest is left to compute
+		with open(path, 'rb') as file:
+			for data in iter(lambda: file.read(CHUNK), b''):
+				blob_hash.update(data)
+	else:
+		# Stream download, decompressing on the fly, and follow the progress
+		unzip = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompress else None
+		with open(path, "wb", buffering=CHUNK) as file:
+			if not decompress: # the blob is written as is, its final size is known
+				preallocate(file.fileno(), size)
+			for chunk in bresp.iter_content(chunk_size=CHUNK): 
+				if aborted.is_set():
+					exit(1)
+				if chunk:
+					blob_hash.update(chunk)
+					if not decompress:
+						file.write(chunk)
+					elif unzip_error is None: # past a decompression error the rest is only hashed
+						try:
+							data = chunk
+							while data: # bounded output, a compressed chunk can expand a thousandfold
+								if unzip.eof: # concatenated gzip members (zero padded or not) are read on like gzip.open does
+									data = data.lstrip(b'\0')
+									if not data:
+										break
+									unzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+								file.write(unzip.decompress(data, CHUNK))
+								data = unzip.unconsumed_tail or unzip.unused_data
+						except DECOMPRESS_ERRORS as e:
+							unzip_error = e
+					progress_bar(ublob, len(chunk))
+			if decompress and unzip_error is None:
+				file.write(unzip.flush())
+				if not unzip.eof:
+					unzip_error = 'truncated gzip stream'
+	if blob_hash.hexdigest() != expected:
+		print_status('ERROR: Digest mismatch for layer {} (got {}:{})'.format(ublob[7:19], algo, blob_hash.hexdigest()))
+		exit(1)
+	if unzip_error is not None:
+		print_status('ERROR: Cannot decompress layer {} ({})'.format(ublob[7:19], unzip_error))
+		exit(1)
+	print_status('{}: Pull complete [{}]'.format(ublob[7:19], size))
+	if args.cache_dir:
+		os.makedirs(os.path.dirname(cached_blob(ublob)), exist_ok=True)
+		if os.path.exists(cache_file): # the manifest repeats this layer and another worker cached it first
+			os.remove(path)
+		else: # moved aside (a copy across filesystems) then renamed, an interrupted move leaves no truncated blob
+			part = cache_file + '.' + os.path.basename(path) + '.part'
+			shutil.move(path, part)
+			os.replace(part, cache_file)
+		return cache_file
+	return path
 
-if len(imgparts[:-1]) != 0:
-	content = { '/'.join(imgparts[:-1]) + '/' + img : { tag : fake_layerid } }
-else: # when pulling only an img (without repo and registry)
-	content = { img : { tag : fake_layerid } }
-file = open(imgdir + '/repositories', 'w')
-file.write(json.dumps(content))
-file.close()
-
-# Create image tar and clean tmp folder
-docker_tar = repo.replace('/', '_') + '_' + img + '.tar'
-sys.stdout.write("Creating archive...")
-sys.stdout.flush()
-tar = tarfile.open(docker_tar, "w")
-tar.add(imgdir, arcname=os.path.sep)
-tar.close()
-shutil.rmtree(imgdir)
-print('\rDocker image pulled: ' + docker_tar)
+# Compute layer IDs
+layerids = []
+parentid=''
+for layer in layers:
+	ublob = layer['digest']
+	# FIXME: Creating fake layer ID. Don't know how Docker generates it
+	fake_layerid = hashlib.sha256((parentid+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
+	layerids.append(fake_layerid)
+	parentid = fake_layerid
+
+# Downloads that failed, the first one is reported
+failed = []
+
+# Called as each download ends, a failure aborts the pull right away
+def download_done(future):
+	if not future.cancelled() and future.exception() is not None:
+		failed.append(future)
+		aborted.set()
+
+# Result of a download, or the error of the first failed one as soon as it happens, whatever the layer order
+def download_result(future):
+	while not future.done() and not aborted.wait(0.1):
+		pass
+	return (failed[0] if failed else future).result()
+
+# Download the config and all layers concurrently, 5 at a time like the Docker client, and archive them in manifest order
+parentid=''
+executor = ThreadPoolExecutor(max_workers=5)
+try:
+	config_future = executor.submit(fetch_config, config)
+	futures = [executor.submit(download_blob, layer, imgdir + '/' + layerid + '.tar') for layer, layerid in zip(layers, layerids)]
+	for future in [config_future] + futures:
+		future.add_done_callback(download_done)
+
+	config_data = download_result(config_future)
+	tar_add_bytes(config_name, config_data)
+	# last layer json = config manifest - history - rootfs
+	# FIXME: json.loads() automatically converts to unicode, thus decoding values whereas Docker doesn't
+	config_obj = json_loads(config_data)
+	del config_obj['history']
+	try:
+		del config_obj['rootfs']
+	except: # Because Microsoft loves case insensitiveness
+		del config_obj['rootfS']
+
+	for layer, fake_layerid, future in zip(layers, layerids, futures):
+		layer_path = download_result(future)
+
+		# OCI layers are archived compressed, under their digest (once, even if the manifest repeats them)
+		if args.format == 'oci':
+			blob_name = 'blobs/' + layer['digest'].replace(':', '/')
+			if blob_name not in content[0]['Layers']:
+				tar.add(layer_path, arcname=blob_name)
+			content[0]['Layers'].append(blob_name)
+			if not args.cache_dir:
+				os.remove(layer_path)
+			continue
+
+		content[0]['Layers'].append(fake_layerid + '/layer.tar')
+
+		# Layer folder, VERSION and json files go straight into the archive
+		info = tarfile.TarInfo(fake_layerid)
+		info.type = tarfile.DIRTYPE
+		info.mode = 0o755
+		info.mtime = time.time()
+		tar.addfile(info)
+		tar_add_bytes(fake_layerid + '/VERSION', b'1.0')
+		if layer is layers[-1]:
+			json_obj = config_obj
+		else: # other layers json are empty
+			json_obj = dict(empty_json_template)
+		json_obj['id'] = fake_layerid
+		if parentid:
+			json_obj['parent'] = parentid
+		parentid = json_obj['id']
+		tar_add_bytes(fake_layerid + '/json', json_dumps(json_obj))
+
+		# Move the finished layer into the archive and free its disk space
+		tar.add(layer_path, arcname=fake_layerid + '/layer.tar')
+		if not args.cache_dir:
+			os.remove(layer_path)
+	executor.shutdown()
+
+	# manifest.json lets docker load read both layouts
+	tar_add_bytes('manifest.json', json_dumps(content))
+
+	if args.format == 'oci':
+		manifest_digest = 'sha256:' + hashlib.sha256(manifest_raw).hexdigest()
+		tar_add_bytes('blobs/' + manifest_digest.replace(':', '/'), manifest_raw)
+		tar_add_bytes('oci-layout', json_dumps({'imageLayoutVersion': '1.0.0'}))
+		index = {
+			'schemaVersion': 2,
+			'mediaType': 'application/vnd.oci.image.index.v1+json',
+			'manifests': [{
+				'mediaType': manifest_data.get('mediaType', 'application/vnd.oci.image.manifest.v1+json'),
+				'digest': manifest_digest,
+				'size': len(manifest_raw),
+				'annotations': {
+					'io.containerd.image.name': content[0]['RepoTags'][0],
+					'org.opencontainers.image.ref.name': tag
+					}
+				}]
+			}
+		tar_add_bytes('index.json', json_dumps(index))
+	else:
+		if len(imgparts[:-1]) != 0:
+			content = { '/'.join(imgparts[:-1]) + '/' + img : { tag : fake_layerid } }
+		else: # when pulling only an img (without repo and registry)
+			content = { img : { tag : fake_layerid } }
+		tar_add_bytes('repositories', json_dumps(content))
+
+	# Finish image tar and clean tmp folder
+	tar.close()
+	os.replace(docker_tar + '.part', docker_tar)
+except BaseException: # a failed layer (or Ctrl-C) cancels the other downloads and the partial archive
+	aborted.set()
+	executor.shutdown(cancel_futures=True)
+	try:
+		tar.close()
+	except Exception: # the archive is dropped anyway, keep the original error
+		pass
+	if os.path.exists(docker_tar + '.part'):
+		os.remove(docker_tar + '.part')
+	shutil.rmtree(imgdir, ignore_errors=True)
+	raise
+os.rmdir(imgdir)
+print_status('Docker image pulled: ' + docker_tar)